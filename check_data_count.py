@@ -3,16 +3,10 @@
 Script to check data count and verify filters
 """
 
-import os
 import sys
 import logging
-import psycopg2
-from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv()
-if not os.getenv('DB_A_HOST'):
-    load_dotenv('config.env')
+from db import get_db_connection, release_db_connection, warn_on_seq_scan
+from script_args import parse_copy_args
 
 def setup_logging():
     """Setup logging configuration"""
@@ -25,27 +19,7 @@ def setup_logging():
     )
     return logging.getLogger(__name__)
 
-def get_db_connection(database='B'):
-    """Get database connection"""
-    if database == 'A':
-        conn = psycopg2.connect(
-            host=os.getenv('DB_A_HOST'),
-            port=os.getenv('DB_A_PORT'),
-            database=os.getenv('DB_A_NAME'),
-            user=os.getenv('DB_A_USER'),
-            password=os.getenv('DB_A_PASSWORD')
-        )
-    else:
-        conn = psycopg2.connect(
-            host=os.getenv('DB_B_HOST'),
-            port=os.getenv('DB_B_PORT'),
-            database=os.getenv('DB_B_NAME'),
-            user=os.getenv('DB_B_USER'),
-            password=os.getenv('DB_B_PASSWORD')
-        )
-    return conn
-
-def check_data_counts(logger, start_date, end_date, warehouse_id):
+def check_data_counts(logger, start_date, end_date, warehouse_id, estimate_totals=False):
     """Check various data counts to understand the filtering"""
     logger.info("=== CHECKING DATA COUNTS ===")
     
@@ -54,70 +28,88 @@ def check_data_counts(logger, start_date, end_date, warehouse_id):
     try:
         cursor_b = conn_b.cursor()
         
+        # The date and warehouse filter every copy script applies to order_main
+        filtered_orders_query = """
+                SELECT order_id, do_number, faktur_date
+                FROM order_main 
+                WHERE faktur_date BETWEEN %s AND %s 
+                AND warehouse_id = %s
+        """
+        
+        # Only this filter should be served by an index, so surface a missing one;
+        # the unfiltered outbound joins in the count query are expected to seq-scan
+        warn_on_seq_scan(logger, cursor_b, filtered_orders_query, (start_date, end_date, warehouse_id))
+        
+        # Checks 1, 4, 5, 6 and 7 share one round trip over the filtered orders
+        counts_query = f"""
+            WITH filtered_orders AS ({filtered_orders_query})
+            SELECT
+                (SELECT COUNT(*) FROM filtered_orders),
+                (SELECT COUNT(DISTINCT fo.order_id)
+                 FROM filtered_orders fo
+                 JOIN outbound_documents odoc ON odoc.document_reference = fo.do_number),
+                (SELECT COUNT(oi.id)
+                 FROM outbound_items oi
+                 JOIN outbound_documents odoc ON odoc.id = oi.outbound_document_id
+                 JOIN filtered_orders fo ON fo.do_number = odoc.document_reference),
+                (SELECT MIN(faktur_date) FROM filtered_orders),
+                (SELECT MAX(faktur_date) FROM filtered_orders),
+                warehouse_range.min_date,
+                warehouse_range.max_date,
+                warehouse_range.total
+            FROM (
+                SELECT MIN(faktur_date) as min_date, MAX(faktur_date) as max_date, COUNT(*) as total
+                FROM order_main 
+                WHERE warehouse_id = %s
+            ) warehouse_range
+        """
+        cursor_b.execute(counts_query, (start_date, end_date, warehouse_id, warehouse_id))
+        (order_count, matching_orders, matching_items, filtered_min_date, filtered_max_date,
+         warehouse_min_date, warehouse_max_date, warehouse_total) = cursor_b.fetchone()
+        
         # Check 1: Total orders in order_main for the date range and warehouse
-        cursor_b.execute("""
-            SELECT COUNT(*) FROM order_main 
-            WHERE faktur_date BETWEEN %s AND %s 
-            AND warehouse_id = %s
-        """, (start_date, end_date, warehouse_id))
-        order_count = cursor_b.fetchone()[0]
         logger.info(f"Total orders in order_main: {order_count}")
         
-        # Check 2: Total outbound_documents
-        cursor_b.execute("""
-            SELECT COUNT(*) FROM outbound_documents
-        """)
-        doc_count = cursor_b.fetchone()[0]
-        logger.info(f"Total outbound_documents: {doc_count}")
+        # Check 2 & 3: Total outbound_documents and outbound_items
+        # Exact by default; with --estimate read planner statistics instead of scanning both tables
+        table_counts = {}
+        if estimate_totals:
+            cursor_b.execute("""
+                SELECT relname, reltuples::bigint
+                FROM pg_class
+                WHERE oid IN ('outbound_documents'::regclass, 'outbound_items'::regclass)
+            """)
+            for table_name, estimate in cursor_b.fetchall():
+                # Never-analyzed tables report -1 (PostgreSQL 14+) or 0 (older), so count those exactly
+                if estimate > 0:
+                    table_counts[table_name] = estimate
+        
+        count_labels = {}
+        for table_name in ('outbound_documents', 'outbound_items'):
+            if table_name in table_counts:
+                count_labels[table_name] = ' (estimated)'
+            else:
+                cursor_b.execute(f"SELECT COUNT(*) FROM {table_name}")
+                table_counts[table_name] = cursor_b.fetchone()[0]
+                count_labels[table_name] = ''
         
-        # Check 3: Total outbound_items
-        cursor_b.execute("""
-            SELECT COUNT(*) FROM outbound_items
-        """)
-        item_count = cursor_b.fetchone()[0]
-        logger.info(f"Total outbound_items: {item_count}")
+        doc_count = table_counts['outbound_documents']
+        logger.info(f"Total outbound_documents{count_labels['outbound_documents']}: {doc_count}")
+        
+        item_count = table_counts['outbound_items']
+        logger.info(f"Total outbound_items{count_labels['outbound_items']}: {item_count}")
         
         # Check 4: Orders with matching do_number in outbound_documents
-        cursor_b.execute("""
-            SELECT COUNT(DISTINCT om.order_id)
-            FROM order_main om
-            JOIN outbound_documents odoc ON odoc.document_reference = om.do_number
-            WHERE om.faktur_date BETWEEN %s AND %s 
-            AND om.warehouse_id = %s
-        """, (start_date, end_date, warehouse_id))
-        matching_orders = cursor_b.fetchone()[0]
         logger.info(f"Orders with matching do_number: {matching_orders}")
         
         # Check 5: Outbound items for matching orders
-        cursor_b.execute("""
-            SELECT COUNT(oi.id)
-            FROM outbound_items oi
-            JOIN outbound_documents odoc ON odoc.id = oi.outbound_document_id
-            JOIN order_main om ON om.do_number = odoc.document_reference
-            WHERE om.faktur_date BETWEEN %s AND %s 
-            AND om.warehouse_id = %s
-        """, (start_date, end_date, warehouse_id))
-        matching_items = cursor_b.fetchone()[0]
         logger.info(f"Outbound items for matching orders: {matching_items}")
         
         # Check 6: Sample of faktur_date range in order_main
-        cursor_b.execute("""
-            SELECT MIN(faktur_date), MAX(faktur_date), COUNT(*)
-            FROM order_main 
-            WHERE warehouse_id = %s
-        """, (warehouse_id,))
-        date_range = cursor_b.fetchone()
-        logger.info(f"Date range for warehouse {warehouse_id}: {date_range[0]} to {date_range[1]} (total: {date_range[2]})")
+        logger.info(f"Date range for warehouse {warehouse_id}: {warehouse_min_date} to {warehouse_max_date} (total: {warehouse_total})")
         
         # Check 7: Sample of faktur_date range for the specific date range
-        cursor_b.execute("""
-            SELECT MIN(faktur_date), MAX(faktur_date), COUNT(*)
-            FROM order_main 
-            WHERE faktur_date BETWEEN %s AND %s 
-            AND warehouse_id = %s
-        """, (start_date, end_date, warehouse_id))
-        filtered_date_range = cursor_b.fetchone()
-        logger.info(f"Filtered date range: {filtered_date_range[0]} to {filtered_date_range[1]} (total: {filtered_date_range[2]})")
+        logger.info(f"Filtered date range: {filtered_min_date} to {filtered_max_date} (total: {order_count})")
         
         return {
             'order_count': order_count,
@@ -131,25 +123,27 @@ def check_data_counts(logger, start_date, end_date, warehouse_id):
         logger.error(f"Error checking data counts: {e}")
         return {}
     finally:
-        conn_b.close()
+        release_db_connection(conn_b, 'B')
 
 def main():
     """Main function"""
-    if len(sys.argv) != 4:
-        print("Usage: python3 check_data_count.py <start_date> <end_date> <warehouse_id>")
+    if len(sys.argv) not in (4, 5) or (len(sys.argv) == 5 and sys.argv[4] != '--estimate'):
+        print("Usage: python3 check_data_count.py <start_date> <end_date> <warehouse_id> [--estimate]")
         print("Example: python3 check_data_count.py 2025-01-01 2025-01-30 4512")
+        print("  --estimate  Use planner statistics for the outbound table totals instead of exact counts")
         sys.exit(1)
     
-    start_date = sys.argv[1]
-    end_date = sys.argv[2]
-    warehouse_id = int(sys.argv[3])
+    estimate_totals = len(sys.argv) == 5
+    
+    # Validate arguments before any database work
+    start_date, end_date, warehouse_id = parse_copy_args(sys.argv)
     
     logger = setup_logging()
     
     logger.info(f"Checking data for date range: {start_date} to {end_date}")
     logger.info(f"Warehouse ID: {warehouse_id}")
     
-    check_data_counts(logger, start_date, end_date, warehouse_id)
+    check_data_counts(logger, start_date, end_date, warehouse_id, estimate_totals)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -7,14 +7,19 @@ Based on mapping rules from outbound_items and related tables
 import os
 import sys
 import logging
-import psycopg2
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from dotenv import load_dotenv
+from psycopg2.extras import RealDictCursor, execute_values
+from db import get_db_connection, release_db_connection, build_upsert_query, POOL_MAX_SIZE
+from script_args import parse_copy_args
 
-# Load environment variables
-load_dotenv()
-if not os.getenv('DB_A_HOST'):
-    load_dotenv('config.env')
+# Columns written to order_detail_main, in the order of the insert values
+ORDER_DETAIL_COLUMNS = (
+    'quantity_faktur', 'net_price', 'quantity_wms', 'quantity_delivery',
+    'quantity_loading', 'quantity_unloading', 'status', 'cancel_reason', 'notes',
+    'order_id', 'product_id', 'unit_id', 'pack_id', 'line_id', 'unloading_latitude',
+    'unloading_longitude', 'origin_uom', 'origin_qty', 'total_ctn', 'total_pcs'
+)
 
 def setup_logging():
     """Setup logging configuration"""
@@ -36,28 +41,8 @@ def setup_logging():
     )
     return logging.getLogger(__name__)
 
-def get_db_connection(database='B'):
-    """Get database connection - all tables are in Database B"""
-    if database == 'A':
-        conn = psycopg2.connect(
-            host=os.getenv('DB_A_HOST'),
-            port=os.getenv('DB_A_PORT'),
-            database=os.getenv('DB_A_NAME'),
-            user=os.getenv('DB_A_USER'),
-            password=os.getenv('DB_A_PASSWORD')
-        )
-    else:
-        conn = psycopg2.connect(
-            host=os.getenv('DB_B_HOST'),
-            port=os.getenv('DB_B_PORT'),
-            database=os.getenv('DB_B_NAME'),
-            user=os.getenv('DB_B_USER'),
-            password=os.getenv('DB_B_PASSWORD')
-        )
-    return conn
-
-def get_product_id_from_sku(logger, sku, pack_id, warehouse_id):
-    """Get product_id from mst_product_main based on sku, pack_id, and warehouse_id"""
+def get_product_ids(logger, skus, warehouse_id):
+    """Get product_id lookups from mst_product_main for all skus of a warehouse in one query"""
     conn_b = get_db_connection('B')
     
     try:
@@ -66,43 +51,47 @@ def get_product_id_from_sku(logger, sku, pack_id, warehouse_id):
         # Convert warehouse_id to string to match VARCHAR column type
         warehouse_id_str = str(warehouse_id)
         
-        # Get product_id based on sku, pack_id, and warehouse_id combination
         query = """
-        SELECT mst_product_id 
+        SELECT sku, pack_id, mst_product_id 
         FROM mst_product_main 
-        WHERE sku = %s AND pack_id = %s AND warehouse_id = %s
-        LIMIT 1
+        WHERE sku = ANY(%s) AND warehouse_id = %s
+        ORDER BY mst_product_id
         """
         
-        cursor_b.execute(query, (sku, pack_id, warehouse_id_str))
-        result = cursor_b.fetchone()
+        cursor_b.execute(query, (list(skus), warehouse_id_str))
         
-        if result:
-            return result[0]
+        # Exact match on (sku, pack_id), plus fallback on sku only
+        products_by_sku_pack = {}
+        products_by_sku = {}
+        for sku, pack_id, mst_product_id in cursor_b.fetchall():
+            products_by_sku_pack.setdefault((sku, pack_id), mst_product_id)
+            products_by_sku.setdefault(sku, mst_product_id)
         
-        # If not found with exact match, try with just sku and warehouse_id
-        query_fallback = """
-        SELECT mst_product_id 
-        FROM mst_product_main 
-        WHERE sku = %s AND warehouse_id = %s
-        LIMIT 1
-        """
-        
-        cursor_b.execute(query_fallback, (sku, warehouse_id_str))
-        result_fallback = cursor_b.fetchone()
-        
-        if result_fallback:
-            logger.warning(f"Product found with sku={sku}, warehouse_id={warehouse_id_str} but pack_id={pack_id} not matched")
-            return result_fallback[0]
-        
-        logger.warning(f"No product found for sku={sku}, pack_id={pack_id}, warehouse_id={warehouse_id_str}")
-        return None
+        logger.info(f"Loaded {len(products_by_sku)} products for {len(skus)} skus")
+        return products_by_sku_pack, products_by_sku
         
     except Exception as e:
-        logger.error(f"Error getting product_id for sku {sku}: {e}")
-        return None
+        logger.error(f"Error getting product_ids for warehouse {warehouse_id}: {e}")
+        return {}, {}
     finally:
-        conn_b.close()
+        release_db_connection(conn_b, 'B')
+
+def resolve_product_id(logger, products, sku, pack_id, warehouse_id):
+    """Resolve product_id from preloaded lookups based on sku, pack_id, and warehouse_id"""
+    products_by_sku_pack, products_by_sku = products
+    
+    product_id = products_by_sku_pack.get((sku, pack_id))
+    if product_id:
+        return product_id
+    
+    # If not found with exact match, try with just sku and warehouse_id
+    product_id = products_by_sku.get(sku)
+    if product_id:
+        logger.warning(f"Product found with sku={sku}, warehouse_id={warehouse_id} but pack_id={pack_id} not matched")
+        return product_id
+    
+    logger.warning(f"No product found for sku={sku}, pack_id={pack_id}, warehouse_id={warehouse_id}")
+    return None
 
 def get_outbound_data(logger, start_date, end_date, warehouse_id):
     """Get outbound data based on the specified query"""
@@ -111,24 +100,21 @@ def get_outbound_data(logger, start_date, end_date, warehouse_id):
     conn_b = get_db_connection('B')  # Use Database B for source data
     
     try:
-        cursor_b = conn_b.cursor()
+        # RealDictCursor returns each row as a dictionary keyed by column name
+        # A plain cursor on purpose: every row is needed before the lookups can run
+        cursor_b = conn_b.cursor(cursor_factory=RealDictCursor)
         
         # Query to get outbound data based on document_reference
-        # Use order_main table in Database B
+        # Use order_main table in Database B, selecting only the columns used below
         query = """
         SELECT 
-            oi.id as outbound_item_id,
             oi.product_id as sku,  -- This is actually SKU, not product_id
             oi.qty,
             oi.uom,
             oi.pack_id,
             oi.line_id,
-            odoc.id as outbound_document_id,
-            odoc.document_reference,
-            om.order_id,
-            om.do_number,
-            om.faktur_date,
-            om.warehouse_id
+            oi.outbound_document_id,
+            om.order_id
         FROM outbound_items oi
         LEFT JOIN outbound_documents odoc ON odoc.id = oi.outbound_document_id
         LEFT JOIN order_main om ON om.do_number = odoc.document_reference
@@ -138,27 +124,9 @@ def get_outbound_data(logger, start_date, end_date, warehouse_id):
         """
         
         cursor_b.execute(query, (start_date, end_date, warehouse_id))
-        results = cursor_b.fetchall()
-        
-        logger.info(f"Retrieved {len(results)} outbound items")
-        
-        # Convert to list of dictionaries for easier processing
-        outbound_data = []
-        for row in results:
-            outbound_data.append({
-                'outbound_item_id': row[0],
-                'sku': row[1],  # This is SKU, not product_id
-                'qty': row[2],
-                'uom': row[3],
-                'pack_id': row[4],
-                'line_id': row[5],
-                'outbound_document_id': row[6],
-                'document_reference': row[7],
-                'order_id': row[8],
-                'do_number': row[9],
-                'faktur_date': row[10],
-                'warehouse_id': row[11]
-            })
+        outbound_data = cursor_b.fetchall()
+        
+        logger.info(f"Retrieved {len(outbound_data)} outbound items")
         
         return outbound_data
         
@@ -166,35 +134,35 @@ def get_outbound_data(logger, start_date, end_date, warehouse_id):
         logger.error(f"Error getting outbound data: {e}")
         return []
     finally:
-        conn_b.close()
+        release_db_connection(conn_b, 'B')
 
-def get_product_net_price(logger, sku, outbound_document_id):
-    """Get product net price from outbound_items"""
+def get_product_net_prices(logger, outbound_document_ids):
+    """Get product net prices from outbound_items for all documents in one query"""
     conn_b = get_db_connection('B')  # Use Database B
     
     try:
         cursor_b = conn_b.cursor()
         
         query = """
-        SELECT product_net_price 
+        SELECT DISTINCT ON (product_id, outbound_document_id)
+            product_id, outbound_document_id, product_net_price 
         FROM outbound_items 
-        WHERE product_id = %s AND outbound_document_id = %s
-        LIMIT 1
+        WHERE outbound_document_id = ANY(%s)
+        ORDER BY product_id, outbound_document_id, id
         """
         
-        cursor_b.execute(query, (sku, outbound_document_id))
-        result = cursor_b.fetchone()
+        cursor_b.execute(query, (list(outbound_document_ids),))
         
-        return result[0] if result else None
+        return {(row[0], row[1]): row[2] for row in cursor_b.fetchall()}
         
     except Exception as e:
-        logger.error(f"Error getting product net price for sku {sku}: {e}")
-        return None
+        logger.error(f"Error getting product net prices: {e}")
+        return {}
     finally:
-        conn_b.close()
+        release_db_connection(conn_b, 'B')
 
-def get_conversion_data(logger, sku, outbound_document_id):
-    """Get conversion data from outbound_conversions"""
+def get_conversion_data(logger, outbound_document_ids):
+    """Get conversion data from outbound_conversions for all documents in one query"""
     conn_b = get_db_connection('B')  # Use Database B
     
     try:
@@ -202,25 +170,26 @@ def get_conversion_data(logger, sku, outbound_document_id):
         
         # Correct relationship: outbound_items.id = outbound_conversions.outbound_item_id
         query = """
-        SELECT oc.numerator, oc.denominator 
+        SELECT DISTINCT ON (oi.product_id, oi.outbound_document_id)
+            oi.product_id, oi.outbound_document_id, oc.numerator, oc.denominator 
         FROM outbound_conversions oc
         JOIN outbound_items oi ON oi.id = oc.outbound_item_id
-        WHERE oi.product_id = %s AND oi.outbound_document_id = %s
-        LIMIT 1
+        WHERE oi.outbound_document_id = ANY(%s)
+        ORDER BY oi.product_id, oi.outbound_document_id, oi.id
         """
         
-        cursor_b.execute(query, (sku, outbound_document_id))
-        result = cursor_b.fetchone()
+        cursor_b.execute(query, (list(outbound_document_ids),))
         
-        if result:
-            return {'numerator': result[0], 'denominator': result[1]}
-        return None
+        return {
+            (row[0], row[1]): {'numerator': row[2], 'denominator': row[3]}
+            for row in cursor_b.fetchall()
+        }
         
     except Exception as e:
-        logger.error(f"Error getting conversion data for sku {sku}: {e}")
-        return None
+        logger.error(f"Error getting conversion data: {e}")
+        return {}
     finally:
-        conn_b.close()
+        release_db_connection(conn_b, 'B')
 
 def calculate_quantities(logger, qty, uom, conversion_data):
     """Calculate quantities based on UOM and conversion rules"""
@@ -257,7 +226,7 @@ def calculate_quantities(logger, qty, uom, conversion_data):
     
     return quantity_faktur, total_pcs, total_ctn
 
-def insert_order_details(logger, order_details_data):
+def insert_order_details(logger, order_details_data, batch_size=1000):
     """Insert order details into order_detail_main table"""
     logger.info("=== INSERTING ORDER DETAILS ===")
     
@@ -266,76 +235,57 @@ def insert_order_details(logger, order_details_data):
     try:
         cursor_b = conn_b.cursor()
         
-        # Insert query for order_detail_main
-        insert_query = """
-        INSERT INTO order_detail_main (
-            quantity_faktur, net_price, quantity_wms, quantity_delivery,
-            quantity_loading, quantity_unloading, status, cancel_reason, notes,
-            order_id, product_id, unit_id, pack_id, line_id, unloading_latitude,
-            unloading_longitude, origin_uom, origin_qty, total_ctn, total_pcs
-        ) VALUES (
-            %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
-        ) ON CONFLICT (order_id, product_id, line_id) DO UPDATE SET
-            quantity_faktur = EXCLUDED.quantity_faktur,
-            net_price = EXCLUDED.net_price,
-            quantity_wms = EXCLUDED.quantity_wms,
-            quantity_delivery = EXCLUDED.quantity_delivery,
-            quantity_loading = EXCLUDED.quantity_loading,
-            quantity_unloading = EXCLUDED.quantity_unloading,
-            status = EXCLUDED.status,
-            cancel_reason = EXCLUDED.cancel_reason,
-            notes = EXCLUDED.notes,
-            unit_id = EXCLUDED.unit_id,
-            pack_id = EXCLUDED.pack_id,
-            unloading_latitude = EXCLUDED.unloading_latitude,
-            unloading_longitude = EXCLUDED.unloading_longitude,
-            origin_uom = EXCLUDED.origin_uom,
-            origin_qty = EXCLUDED.origin_qty,
-            total_ctn = EXCLUDED.total_ctn,
-            total_pcs = EXCLUDED.total_pcs
-        """
+        # Insert query for order_detail_main, skipping updates when nothing changed
+        insert_query = build_upsert_query(
+            'order_detail_main', ORDER_DETAIL_COLUMNS, ('order_id', 'product_id', 'line_id'), 'VALUES %s'
+        )
+        
+        # One statement cannot upsert the same key twice, keep the last occurrence
+        unique_details = {}
+        for detail in order_details_data:
+            unique_details[(detail['order_id'], detail['product_id'], detail['line_id'])] = detail
+        
+        duplicate_count = len(order_details_data) - len(unique_details)
+        if duplicate_count:
+            logger.info(f"Merged {duplicate_count} duplicate order details")
+        
+        unique_details = list(unique_details.values())
         
         inserted_count = 0
         skipped_count = 0
         
-        for detail in order_details_data:
+        for i in range(0, len(unique_details), batch_size):
+            batch = unique_details[i:i + batch_size]
+            
+            # Prepare data for insertion
+            # Values follow ORDER_DETAIL_COLUMNS, so they always line up with the insert columns
+            batch_values = [tuple(detail[column] for column in ORDER_DETAIL_COLUMNS) for detail in batch]
+            
             try:
-                # Prepare data for insertion
-                insert_data = (
-                    detail['quantity_faktur'],      # quantity_faktur
-                    detail['net_price'],            # net_price
-                    None,                           # quantity_wms
-                    None,                           # quantity_delivery
-                    None,                           # quantity_loading
-                    None,                           # quantity_unloading
-                    None,                           # status
-                    None,                           # cancel_reason
-                    None,                           # notes
-                    detail['order_id'],             # order_id
-                    detail['product_id'],           # product_id
-                    None,                           # unit_id
-                    detail['pack_id'],              # pack_id
-                    detail['line_id'],              # line_id
-                    None,                           # unloading_latitude
-                    None,                           # unloading_longitude
-                    detail['origin_uom'],           # origin_uom
-                    detail['origin_qty'],           # origin_qty
-                    detail['total_ctn'],            # total_ctn
-                    detail['total_pcs']             # total_pcs
-                )
+                execute_values(cursor_b, insert_query, batch_values, page_size=batch_size)
+                conn_b.commit()
+                inserted_count += len(batch_values)
                 
-                cursor_b.execute(insert_query, insert_data)
-                inserted_count += 1
+            except Exception as e:
+                conn_b.rollback()
+                logger.warning(f"Batch {i//batch_size + 1} failed, retrying record by record: {e}")
                 
-                if inserted_count % 100 == 0:
-                    logger.info(f"Inserted {inserted_count} order details...")
+                # Locate the failing records, keeping the good ones of this batch
+                for detail, insert_data in zip(batch, batch_values):
+                    cursor_b.execute("SAVEPOINT order_detail_row")
+                    try:
+                        execute_values(cursor_b, insert_query, [insert_data])
+                        cursor_b.execute("RELEASE SAVEPOINT order_detail_row")
+                        inserted_count += 1
+                    except Exception as e:
+                        cursor_b.execute("ROLLBACK TO SAVEPOINT order_detail_row")
+                        logger.error(f"Error inserting order detail for order_id {detail['order_id']}, product_id {detail['product_id']}: {e}")
+                        skipped_count += 1
                 
-            except Exception as e:
-                logger.error(f"Error inserting order detail for order_id {detail['order_id']}, product_id {detail['product_id']}: {e}")
-                skipped_count += 1
-                continue
+                conn_b.commit()
+            
+            logger.info(f"Inserted {inserted_count} order details...")
         
-        conn_b.commit()
         logger.info(f"✅ Order details insertion completed!")
         logger.info(f"Total inserted: {inserted_count}")
         logger.info(f"Total skipped: {skipped_count}")
@@ -347,7 +297,7 @@ def insert_order_details(logger, order_details_data):
         logger.error(f"Error in insert_order_details: {e}")
         return 0, 0
     finally:
-        conn_b.close()
+        release_db_connection(conn_b, 'B')
 
 def copy_order_details(logger, start_date, end_date, warehouse_id):
     """Main function to copy order details"""
@@ -362,27 +312,47 @@ def copy_order_details(logger, start_date, end_date, warehouse_id):
         logger.warning("No outbound data found for the specified criteria")
         return 0, 0
     
-    # Step 2: Process and transform data
+    # Step 2: Load lookup data once for all items instead of querying per item
+    logger.info("=== LOADING LOOKUP DATA ===")
+    
+    skus = {item['sku'] for item in outbound_data}
+    outbound_document_ids = {item['outbound_document_id'] for item in outbound_data}
+    
+    # The three lookups are independent, so run them concurrently on pooled connections
+    # The pool raises instead of waiting when exhausted, so never use more workers than connections
+    with ThreadPoolExecutor(max_workers=min(3, POOL_MAX_SIZE)) as executor:
+        products_future = executor.submit(get_product_ids, logger, skus, warehouse_id)
+        net_prices_future = executor.submit(get_product_net_prices, logger, outbound_document_ids)
+        conversions_future = executor.submit(get_conversion_data, logger, outbound_document_ids)
+        
+        products = products_future.result()
+        net_prices = net_prices_future.result()
+        conversions = conversions_future.result()
+    
+    # Step 3: Process and transform data
     logger.info("=== PROCESSING AND TRANSFORMING DATA ===")
     
     order_details_data = []
     
     for i, item in enumerate(outbound_data):
         try:
-            logger.debug(f"Processing item {i+1}/{len(outbound_data)}: order_id {item['order_id']}, sku {item['sku']}")
+            # Lazy formatting: the message is only built when DEBUG is enabled
+            logger.debug("Processing item %d/%d: order_id %s, sku %s",
+                         i + 1, len(outbound_data), item['order_id'], item['sku'])
             
             # Get correct product_id from mst_product_main based on sku, pack_id, and warehouse_id
-            product_id = get_product_id_from_sku(logger, item['sku'], item['pack_id'], warehouse_id)
+            product_id = resolve_product_id(logger, products, item['sku'], item['pack_id'], warehouse_id)
             
             if not product_id:
                 logger.warning(f"Skipping item {i+1}: No product_id found for sku={item['sku']}, pack_id={item['pack_id']}, warehouse_id={warehouse_id}")
                 continue
             
             # Get product net price
-            net_price = get_product_net_price(logger, item['sku'], item['outbound_document_id'])
+            lookup_key = (item['sku'], item['outbound_document_id'])
+            net_price = net_prices.get(lookup_key)
             
             # Get conversion data
-            conversion_data = get_conversion_data(logger, item['sku'], item['outbound_document_id'])
+            conversion_data = conversions.get(lookup_key)
             
             # Calculate quantities based on UOM and conversion rules
             quantity_faktur, total_pcs, total_ctn = calculate_quantities(
@@ -390,13 +360,24 @@ def copy_order_details(logger, start_date, end_date, warehouse_id):
             )
             
             # Prepare order detail data
+            # Keys match ORDER_DETAIL_COLUMNS, columns not filled by this copy stay NULL
             order_detail = {
-                'order_id': item['order_id'],
-                'product_id': product_id,  # Use the correct product_id from mst_product_main
                 'quantity_faktur': quantity_faktur,
                 'net_price': net_price,
+                'quantity_wms': None,
+                'quantity_delivery': None,
+                'quantity_loading': None,
+                'quantity_unloading': None,
+                'status': None,
+                'cancel_reason': None,
+                'notes': None,
+                'order_id': item['order_id'],
+                'product_id': product_id,  # Use the correct product_id from mst_product_main
+                'unit_id': None,
                 'pack_id': item['pack_id'],
                 'line_id': item['line_id'],
+                'unloading_latitude': None,
+                'unloading_longitude': None,
                 'origin_uom': item['uom'],
                 'origin_qty': item['qty'],
                 'total_ctn': total_ctn,
@@ -414,7 +395,7 @@ def copy_order_details(logger, start_date, end_date, warehouse_id):
     
     logger.info(f"Processed {len(order_details_data)} order details")
     
-    # Step 3: Insert data into order_detail_main
+    # Step 4: Insert data into order_detail_main
     inserted_count, skipped_count = insert_order_details(logger, order_details_data)
     
     return inserted_count, skipped_count
@@ -426,9 +407,8 @@ def main():
         print("Example: python3 copy_order_details.py 2025-01-01 2025-01-30 4512")
         sys.exit(1)
     
-    start_date = sys.argv[1]
-    end_date = sys.argv[2]
-    warehouse_id = int(sys.argv[3])
+    # Validate arguments before any database work
+    start_date, end_date, warehouse_id = parse_copy_args(sys.argv)
     
     logger = setup_logging()
     
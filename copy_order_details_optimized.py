@@ -5,16 +5,20 @@ Uses JOIN queries to reduce database calls from 223,956 to 1-2 queries
 Estimated time: 5-10 minutes instead of 5.5 hours
 """
 
-import os
+import io
 import sys
-import psycopg2
-import psycopg2.extras
-from dotenv import load_dotenv
 import logging
 from datetime import datetime
+from itertools import islice
+from psycopg2.extras import RealDictCursor
+from db import get_db_connection, release_db_connection, build_upsert_query, POOL_MAX_SIZE
+from script_args import parse_copy_args
 
-# Load environment variables
-load_dotenv('.env')
+# Columns streamed into order_detail_main, in the order of the COPY rows
+ORDER_DETAIL_COLUMNS = (
+    'order_id', 'product_id', 'quantity_faktur', 'net_price',
+    'pack_id', 'line_id', 'origin_uom', 'origin_qty', 'total_ctn', 'total_pcs'
+)
 
 def setup_logging():
     """Setup logging configuration"""
@@ -28,43 +32,32 @@ def setup_logging():
     )
     return logging.getLogger(__name__)
 
-def get_db_connection(database='B'):
-    """Get database connection"""
-    if database == 'B':
-        return psycopg2.connect(
-            host=os.getenv('DB_B_HOST'),
-            database=os.getenv('DB_B_NAME'),
-            user=os.getenv('DB_B_USER'),
-            password=os.getenv('DB_B_PASSWORD'),
-            port=os.getenv('DB_B_PORT')
-        )
-
 def get_optimized_outbound_data(logger, start_date, end_date, warehouse_id):
-    """Get all outbound data with JOIN queries in one go"""
+    """Stream all outbound data from one JOIN query, yielding rows as they arrive"""
     conn_b = get_db_connection('B')
     
     try:
-        cursor_b = conn_b.cursor()
+        # Every row is consumed, so plan for the whole result rather than a fast first row
+        conn_b.cursor().execute("SET LOCAL cursor_tuple_fraction = 1.0")
+        
+        # Server-side cursor fetches rows from the server in chunks of itersize
+        # RealDictCursor returns each row as a dictionary keyed by column name
+        cursor_b = conn_b.cursor(name='optimized_outbound_data', cursor_factory=RealDictCursor)
+        cursor_b.itersize = 10000
         
-        # Single optimized query with JOINs to get all data at once
+        # Single optimized query with JOINs to get all data at once (only the columns used below)
         query = """
         SELECT 
-            oi.id,
             oi.product_id as sku,
             oi.qty,
             oi.uom,
             oi.pack_id,
             oi.line_id,
-            oi.outbound_document_id,
-            odoc.document_reference,
             om.order_id,
-            om.do_number,
-            om.faktur_date,
-            om.warehouse_id,
-            mp.mst_product_id,
-            oi.product_net_price,
-            oc.numerator,
-            oc.denominator
+            mp.mst_product_id as product_id,    -- From mst_product_main
+            oi.product_net_price as net_price,  -- From outbound_items
+            oc.numerator,                       -- From outbound_conversions
+            oc.denominator                      -- From outbound_conversions
         FROM outbound_items oi
         LEFT JOIN outbound_documents odoc ON odoc.id = oi.outbound_document_id
         LEFT JOIN order_main om ON om.do_number = odoc.document_reference
@@ -82,38 +75,19 @@ def get_optimized_outbound_data(logger, start_date, end_date, warehouse_id):
         logger.info("Executing optimized JOIN query...")
         cursor_b.execute(query, (str(warehouse_id), start_date, end_date, warehouse_id))
         
-        results = cursor_b.fetchall()
-        logger.info(f"Retrieved {len(results)} records with optimized query")
+        # Rows are handed on one at a time, so at most one itersize chunk is held here
+        row_count = 0
+        for row in cursor_b:
+            row_count += 1
+            yield row
         
-        # Transform results into structured data
-        outbound_data = []
-        for row in results:
-            outbound_data.append({
-                'id': row[0],
-                'sku': row[1],
-                'qty': row[2],
-                'uom': row[3],
-                'pack_id': row[4],
-                'line_id': row[5],
-                'outbound_document_id': row[6],
-                'document_reference': row[7],
-                'order_id': row[8],
-                'do_number': row[9],
-                'faktur_date': row[10],
-                'warehouse_id': row[11],
-                'product_id': row[12],  # From mst_product_main
-                'net_price': row[13],   # From outbound_items
-                'numerator': row[14],   # From outbound_conversions
-                'denominator': row[15]  # From outbound_conversions
-            })
-        
-        return outbound_data
+        logger.info(f"Retrieved {row_count} records with optimized query")
         
     except Exception as e:
         logger.error(f"Error getting optimized outbound data: {e}")
-        return []
+        raise
     finally:
-        conn_b.close()
+        release_db_connection(conn_b, 'B')
 
 def calculate_quantities_optimized(qty, uom, numerator, denominator):
     """Calculate quantities based on UOM and conversion rules"""
@@ -148,70 +122,76 @@ def calculate_quantities_optimized(qty, uom, numerator, denominator):
         # Return safe defaults if calculation fails
         return qty, qty, 0
 
-def insert_order_details_batch(logger, order_details_data, batch_size=1000):
-    """Insert order details in batches with UPSERT"""
-    if not order_details_data:
-        logger.warning("No order details data to insert")
-        return 0, 0
-    
+def format_copy_value(value):
+    """Format a value for COPY text format"""
+    if value is None:
+        return '\\N'
+    return (str(value)
+            .replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r'))
+
+def insert_order_details_batch(logger, order_details, batch_size=1000):
+    """Insert order details from an iterable in batches with UPSERT, streaming each batch through COPY"""
     conn_b = get_db_connection('B')
     
+    columns = ', '.join(ORDER_DETAIL_COLUMNS)
+    
     try:
         cursor_b = conn_b.cursor()
         
+        # Staging table with the same column types; emptied on every commit
+        # Pooled connections keep their session, so the table may exist from an earlier call
+        cursor_b.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS order_detail_staging ON COMMIT DELETE ROWS AS
+        SELECT {columns} FROM order_detail_main WITH NO DATA
+        """)
+        
+        # UPSERT from staging with correct constraint, skipping rows that are unchanged
+        upsert_query = build_upsert_query(
+            'order_detail_main', ORDER_DETAIL_COLUMNS, ('order_id', 'product_id', 'line_id'),
+            f"SELECT {columns} FROM order_detail_staging"
+        )
+        
         inserted_count = 0
         skipped_count = 0
+        batch_number = 0
         
-        # Process in batches
-        for i in range(0, len(order_details_data), batch_size):
-            batch = order_details_data[i:i + batch_size]
+        # Process in batches, pulling only batch_size items from the iterable at a time
+        order_details = iter(order_details)
+        while True:
+            batch = list(islice(order_details, batch_size))
+            if not batch:
+                break
+            batch_number += 1
             
-            # Prepare batch data
-            batch_values = []
+            # Prepare batch data as COPY text rows
+            buffer = io.StringIO()
+            batch_count = 0
             for item in batch:
                 if not item['product_id']:
                     skipped_count += 1
                     continue
-                    
-                batch_values.append((
-                    item['order_id'],
-                    item['product_id'],
-                    item['quantity_faktur'],
-                    item['net_price'],
-                    item['pack_id'],
-                    item['line_id'],
-                    item['origin_uom'],
-                    item['origin_qty'],
-                    item['total_ctn'],
-                    item['total_pcs']
-                ))
+                
+                # Values follow ORDER_DETAIL_COLUMNS, so they always line up with the COPY columns
+                buffer.write('\t'.join(format_copy_value(item[column]) for column in ORDER_DETAIL_COLUMNS) + '\n')
+                batch_count += 1
             
-            if not batch_values:
+            if not batch_count:
                 continue
             
-            # UPSERT query for batch with correct constraint
-            query = """
-            INSERT INTO order_detail_main (
-                order_id, product_id, quantity_faktur, net_price, 
-                pack_id, line_id, origin_uom, origin_qty, total_ctn, total_pcs
-            ) VALUES %s
-            ON CONFLICT (order_id, product_id, line_id) 
-            DO UPDATE SET
-                quantity_faktur = EXCLUDED.quantity_faktur,
-                net_price = EXCLUDED.net_price,
-                pack_id = EXCLUDED.pack_id,
-                origin_uom = EXCLUDED.origin_uom,
-                origin_qty = EXCLUDED.origin_qty,
-                total_ctn = EXCLUDED.total_ctn,
-                total_pcs = EXCLUDED.total_pcs
-            """
-            
-            # Execute batch insert
-            psycopg2.extras.execute_values(cursor_b, query, batch_values)
+            # Stream batch into staging, then upsert in one statement
+            buffer.seek(0)
+            cursor_b.copy_expert(f"COPY order_detail_staging ({columns}) FROM STDIN", buffer)
+            cursor_b.execute(upsert_query)
             conn_b.commit()
             
-            inserted_count += len(batch_values)
-            logger.info(f"Inserted batch {i//batch_size + 1}: {len(batch_values)} records (Total: {inserted_count})")
+            inserted_count += batch_count
+            logger.info(f"Inserted batch {batch_number}: {batch_count} records (Total: {inserted_count})")
+        
+        if not batch_number:
+            logger.warning("No order details data to insert")
         
         return inserted_count, skipped_count
         
@@ -220,35 +200,20 @@ def insert_order_details_batch(logger, order_details_data, batch_size=1000):
         conn_b.rollback()
         return 0, 0
     finally:
-        conn_b.close()
+        release_db_connection(conn_b, 'B')
 
-def copy_order_details_optimized(logger, start_date, end_date, warehouse_id):
-    """Main optimized function to copy order details"""
-    logger.info("=== STARTING OPTIMIZED ORDER DETAILS COPY PROCESS ===")
-    logger.info(f"Date range: {start_date} to {end_date}")
-    logger.info(f"Warehouse ID: {warehouse_id}")
-    
-    # Step 1: Get all data with single optimized query
-    logger.info("=== EXECUTING OPTIMIZED DATA RETRIEVAL ===")
-    outbound_data = get_optimized_outbound_data(logger, start_date, end_date, warehouse_id)
-    
-    if not outbound_data:
-        logger.warning("No outbound data found for the specified criteria")
-        return 0, 0
-    
-    # Step 2: Process and transform data in memory
-    logger.info("=== PROCESSING AND TRANSFORMING DATA ===")
-    
-    order_details_data = []
-    valid_count = 0
-    skipped_count = 0
+def iter_order_details(logger, outbound_rows, stats):
+    """Transform and deduplicate outbound rows into order details as they stream in"""
+    # Only the keys are kept across the whole run, to prevent UPSERT conflicts within a batch
+    seen_keys = set()
     
-    for i, item in enumerate(outbound_data):
+    for i, item in enumerate(outbound_rows):
+        stats['rows'] += 1
         try:
             # Skip if no product_id found
             if not item['product_id']:
-                skipped_count += 1
-                if skipped_count <= 10:  # Log first 10 skips
+                stats['skipped'] += 1
+                if stats['skipped'] <= 10:  # Log first 10 skips
                     logger.warning(f"Skipping item {i+1}: No product_id found for sku={item['sku']}, pack_id={item['pack_id']}")
                 continue
             
@@ -270,42 +235,53 @@ def copy_order_details_optimized(logger, start_date, end_date, warehouse_id):
                 'total_ctn': total_ctn,
                 'total_pcs': total_pcs
             }
-            
-            order_details_data.append(order_detail)
-            valid_count += 1
+            stats['valid'] += 1
             
             if (i + 1) % 5000 == 0:
-                logger.info(f"Processed {i+1}/{len(outbound_data)} items (Valid: {valid_count}, Skipped: {skipped_count})")
-                
+                logger.info(f"Processed {i+1} items (Valid: {stats['valid']}, Skipped: {stats['skipped']})")
+            
+            key = (order_detail['order_id'], order_detail['product_id'], order_detail['line_id'])
+            if key in seen_keys:
+                stats['duplicates'] += 1
+                continue
+            seen_keys.add(key)
+            
         except Exception as e:
             logger.error(f"Error processing item {i+1}: {e}")
-            skipped_count += 1
+            stats['skipped'] += 1
             continue
+        
+        yield order_detail
+
+def copy_order_details_optimized(logger, start_date, end_date, warehouse_id):
+    """Main optimized function to copy order details"""
+    logger.info("=== STARTING OPTIMIZED ORDER DETAILS COPY PROCESS ===")
+    logger.info(f"Date range: {start_date} to {end_date}")
+    logger.info(f"Warehouse ID: {warehouse_id}")
     
-    logger.info(f"Processing complete: {valid_count} valid items, {skipped_count} skipped items")
-    
-    # Step 2.5: Deduplicate data to prevent UPSERT conflicts
-    logger.info("=== DEDUPLICATING DATA ===")
-    unique_order_details = []
-    seen_keys = set()
-    duplicate_count = 0
-    
-    for item in order_details_data:
-        key = (item['order_id'], item['product_id'], item['line_id'])
-        if key not in seen_keys:
-            seen_keys.add(key)
-            unique_order_details.append(item)
-        else:
-            duplicate_count += 1
+    # Reading and inserting each hold a connection at the same time
+    if POOL_MAX_SIZE < 2:
+        logger.error(f"DB_POOL_MAX_SIZE must be at least 2 to stream and insert concurrently (got {POOL_MAX_SIZE})")
+        return 0, 0
     
-    logger.info(f"Deduplication complete: {len(unique_order_details)} unique items, {duplicate_count} duplicates removed")
+    # Rows flow from the single optimized query through the transform into COPY batches,
+    # so memory is bounded by one fetch chunk and one insert batch instead of the full result
+    logger.info("=== STREAMING, TRANSFORMING AND BATCH INSERTING DATA ===")
+    stats = {'rows': 0, 'valid': 0, 'skipped': 0, 'duplicates': 0}
+    outbound_rows = get_optimized_outbound_data(logger, start_date, end_date, warehouse_id)
+    order_details = iter_order_details(logger, outbound_rows, stats)
+    try:
+        inserted_count, final_skipped_count = insert_order_details_batch(logger, order_details)
+    finally:
+        # Release the reading connection even if inserting stopped before the stream ended
+        outbound_rows.close()
     
-    # Replace with deduplicated data
-    order_details_data = unique_order_details
+    if not stats['rows']:
+        logger.warning("No outbound data found for the specified criteria")
+        return 0, 0
     
-    # Step 3: Batch insert data into order_detail_main
-    logger.info("=== BATCH INSERTING TO DATABASE ===")
-    inserted_count, final_skipped_count = insert_order_details_batch(logger, order_details_data)
+    logger.info(f"Processing complete: {stats['valid']} valid items, {stats['skipped']} skipped items")
+    logger.info(f"Deduplication complete: {stats['valid'] - stats['duplicates']} unique items, {stats['duplicates']} duplicates removed")
     
     return inserted_count, final_skipped_count
 
@@ -316,9 +292,8 @@ def main():
         print("Example: python3 copy_order_details_optimized.py 2025-01-01 2025-01-30 4512")
         sys.exit(1)
     
-    start_date = sys.argv[1]
-    end_date = sys.argv[2]
-    warehouse_id = int(sys.argv[3])
+    # Validate arguments before any database work
+    start_date, end_date, warehouse_id = parse_copy_args(sys.argv)
     
     logger = setup_logging()
     
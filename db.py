@@ -0,0 +1,104 @@
+"""
+Shared database helpers for Database A and Database B
+Connections are pooled per database and reused for the lifetime of the process
+"""
+
+import os
+import atexit
+import threading
+from psycopg2.pool import ThreadedConnectionPool
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+if not os.getenv('DB_A_HOST'):
+    load_dotenv('config.env')
+
+# Connection settings, read once at import time
+_DB_CONFIG = {
+    database: {
+        'host': os.getenv(f'{prefix}_HOST'),
+        'port': os.getenv(f'{prefix}_PORT'),
+        'database': os.getenv(f'{prefix}_NAME'),
+        'user': os.getenv(f'{prefix}_USER'),
+        'password': os.getenv(f'{prefix}_PASSWORD'),
+        'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', 10)),
+        'keepalives_idle': int(os.getenv('DB_KEEPALIVES_IDLE', 30))
+    }
+    for database, prefix in (('A', 'DB_A'), ('B', 'DB_B'))
+}
+_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', 1))
+# Public so callers can size their worker threads to the pool
+POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 4))
+
+# Connection pools, created lazily per database and reused across calls
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+def _get_connection_pool(database='B'):
+    """Get (or create) the connection pool for a database"""
+    # Lock so concurrent first calls from worker threads build only one pool
+    with _connection_pools_lock:
+        if database not in _connection_pools:
+            config = _DB_CONFIG['A' if database == 'A' else 'B']
+            _connection_pools[database] = ThreadedConnectionPool(_POOL_MIN_SIZE, POOL_MAX_SIZE, **config)
+        return _connection_pools[database]
+
+def get_db_connection(database='B'):
+    """Get pooled database connection"""
+    return _get_connection_pool(database).getconn()
+
+def release_db_connection(conn, database='B'):
+    """Return connection to its pool (uncommitted work is rolled back)"""
+    _get_connection_pool(database).putconn(conn)
+
+def close_db_connections():
+    """Close all pooled connections"""
+    for connection_pool in _connection_pools.values():
+        connection_pool.closeall()
+    _connection_pools.clear()
+
+atexit.register(close_db_connections)
+
+def build_upsert_query(table, columns, conflict_columns, source):
+    """Build an INSERT ... ON CONFLICT DO UPDATE query that skips unchanged rows"""
+    update_columns = [column for column in columns if column not in conflict_columns]
+    assignments = ',\n            '.join(f"{column} = EXCLUDED.{column}" for column in update_columns)
+    return f"""
+        INSERT INTO {table} ({', '.join(columns)})
+        {source}
+        ON CONFLICT ({', '.join(conflict_columns)}) DO UPDATE SET
+            {assignments}
+        WHERE ({', '.join(f'{table}.{column}' for column in update_columns)})
+        IS DISTINCT FROM ({', '.join(f'EXCLUDED.{column}' for column in update_columns)})
+        """
+
+def warn_on_seq_scan(logger, cursor, query, params, min_rows=10000):
+    """Log a warning for every sequential scan of a large table in the plan of a query"""
+    cursor.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+    plan = cursor.fetchone()[0]
+    
+    seq_scans = set()
+    nodes = [plan[0]['Plan']]
+    while nodes:
+        node = nodes.pop()
+        if node['Node Type'] == 'Seq Scan':
+            seq_scans.add(node['Relation Name'])
+        nodes.extend(node.get('Plans', []))
+    
+    if not seq_scans:
+        return []
+    
+    # A sequential scan is the right plan for small tables, only report large ones
+    cursor.execute("""
+        SELECT relname, MAX(reltuples)::bigint
+        FROM pg_class
+        WHERE relname = ANY(%s) AND relkind = 'r'
+        GROUP BY relname
+        HAVING MAX(reltuples) >= %s
+    """, (list(seq_scans), min_rows))
+    large_tables = cursor.fetchall()
+    
+    for table_name, estimate in large_tables:
+        logger.warning(f"Query plan uses a sequential scan on {table_name} (~{estimate} rows), check that its filter columns are indexed")
+    return [table_name for table_name, estimate in large_tables]
@@ -0,0 +1,37 @@
+"""
+Shared helpers for the order detail debug scripts
+"""
+
+import logging
+
+def setup_logging():
+    """Setup logging configuration"""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    return logging.getLogger(__name__)
+
+def get_do_number_analysis(cursor, do_numbers):
+    """Get order, item count and product match count per DO number"""
+    placeholders = ','.join(['%s'] * len(do_numbers))
+    query = f"""
+    SELECT
+        odoc.document_reference,
+        om.order_id,
+        om.faktur_date,
+        om.warehouse_id,
+        COUNT(oi.id) as item_count,
+        COUNT(mp.mst_product_id) as product_matches
+    FROM outbound_documents odoc
+    LEFT JOIN outbound_items oi ON odoc.id = oi.outbound_document_id
+    LEFT JOIN order_main om ON om.do_number = odoc.document_reference
+    LEFT JOIN mst_product_main mp ON (
+        mp.sku = oi.product_id
+        AND mp.pack_id = oi.pack_id
+        AND mp.warehouse_id = om.warehouse_id::varchar
+    )
+    WHERE odoc.document_reference IN ({placeholders})
+    GROUP BY odoc.document_reference, om.order_id, om.faktur_date, om.warehouse_id
+    ORDER BY odoc.document_reference
+    """
+
+    cursor.execute(query, do_numbers)
+    return cursor.fetchall()
@@ -3,30 +3,9 @@
 Debug script to investigate missing order details in February 2025
 """
 
-import os
 import sys
-import psycopg2
-from dotenv import load_dotenv
-import logging
-
-# Load environment variables
-load_dotenv('.env')
-
-def setup_logging():
-    """Setup logging configuration"""
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-    return logging.getLogger(__name__)
-
-def get_db_connection(database='B'):
-    """Get database connection"""
-    if database == 'B':
-        return psycopg2.connect(
-            host=os.getenv('DB_B_HOST'),
-            database=os.getenv('DB_B_NAME'),
-            user=os.getenv('DB_B_USER'),
-            password=os.getenv('DB_B_PASSWORD'),
-            port=os.getenv('DB_B_PORT')
-        )
+from db import get_db_connection, release_db_connection
+from debug_common import setup_logging, get_do_number_analysis
 
 def debug_february_gap(logger, warehouse_id=4512):
     """Debug missing order details in February 2025"""
@@ -38,16 +17,34 @@ def debug_february_gap(logger, warehouse_id=4512):
         logger.info("=== DEBUGGING FEBRUARY 2025 GAP ===")
         logger.info(f"Warehouse ID: {warehouse_id}")
         
-        # Step 1: Find orders without details in February 2025
+        # Step 1: Find orders without details in February 2025, together with
+        # the outbound item count of their DO number (NULL if no outbound document)
         logger.info("1. Finding orders without details in February 2025...")
         query1 = """
-        SELECT o.order_id, o.do_number, o.faktur_date, o.warehouse_id
-        FROM order_main o
-        LEFT JOIN order_detail_main od ON o.order_id = od.order_id
-        WHERE o.faktur_date BETWEEN '2025-02-01' AND '2025-02-28'
-        AND o.warehouse_id = %s
-        AND od.order_id IS NULL
-        ORDER BY o.faktur_date, o.order_id
+        WITH missing_orders AS (
+            SELECT o.order_id, o.do_number, o.faktur_date
+            FROM order_main o
+            LEFT JOIN order_detail_main od ON o.order_id = od.order_id
+            WHERE o.faktur_date BETWEEN '2025-02-01' AND '2025-02-28'
+            AND o.warehouse_id = %s
+            AND od.order_id IS NULL
+        ),
+        do_items AS (
+            -- Items are counted per document by the LATERAL subquery, then summed per DO number
+            SELECT odoc.document_reference, COALESCE(SUM(items.item_count), 0)::bigint as item_count
+            FROM outbound_documents odoc
+            CROSS JOIN LATERAL (
+                SELECT COUNT(*) as item_count
+                FROM outbound_items oi
+                WHERE oi.outbound_document_id = odoc.id
+            ) items
+            WHERE odoc.document_reference IN (SELECT do_number FROM missing_orders)
+            GROUP BY odoc.document_reference
+        )
+        SELECT mo.order_id, mo.do_number, mo.faktur_date, di.item_count
+        FROM missing_orders mo
+        LEFT JOIN do_items di ON di.document_reference = mo.do_number
+        ORDER BY mo.faktur_date, mo.order_id
         """
         
         cursor_b.execute(query1, (warehouse_id,))
@@ -76,19 +73,12 @@ def debug_february_gap(logger, warehouse_id=4512):
             logger.warning("   ⚠ No DO numbers found in missing orders")
             return
         
-        # Check outbound_documents
-        placeholders = ','.join(['%s'] * len(do_numbers))
-        query2 = f"""
-        SELECT odoc.document_reference, COUNT(oi.id) as item_count
-        FROM outbound_documents odoc
-        LEFT JOIN outbound_items oi ON odoc.id = oi.outbound_document_id
-        WHERE odoc.document_reference IN ({placeholders})
-        GROUP BY odoc.document_reference
-        ORDER BY item_count DESC
-        """
-        
-        cursor_b.execute(query2, do_numbers)
-        outbound_results = cursor_b.fetchall()
+        # Outbound item counts were fetched with the orders, one entry per DO number
+        item_counts = {}
+        for order in missing_orders:
+            if order[1] and order[3] is not None:
+                item_counts[order[1]] = order[3]
+        outbound_results = sorted(item_counts.items(), key=lambda result: result[1], reverse=True)
         
         logger.info(f"   ✓ Found {len(outbound_results)} DO numbers with outbound data")
         
@@ -120,31 +110,7 @@ def debug_february_gap(logger, warehouse_id=4512):
             
             # Get detailed info for first few DO numbers
             sample_do_numbers = do_with_items[:5]
-            placeholders = ','.join(['%s'] * len(sample_do_numbers))
-            
-            query3 = f"""
-            SELECT 
-                odoc.document_reference,
-                om.order_id,
-                om.faktur_date,
-                om.warehouse_id,
-                COUNT(oi.id) as item_count,
-                COUNT(mp.mst_product_id) as product_matches
-            FROM outbound_documents odoc
-            LEFT JOIN outbound_items oi ON odoc.id = oi.outbound_document_id
-            LEFT JOIN order_main om ON om.do_number = odoc.document_reference
-            LEFT JOIN mst_product_main mp ON (
-                mp.sku = oi.product_id 
-                AND mp.pack_id = oi.pack_id 
-                AND mp.warehouse_id = om.warehouse_id::varchar
-            )
-            WHERE odoc.document_reference IN ({placeholders})
-            GROUP BY odoc.document_reference, om.order_id, om.faktur_date, om.warehouse_id
-            ORDER BY odoc.document_reference
-            """
-            
-            cursor_b.execute(query3, sample_do_numbers)
-            detailed_results = cursor_b.fetchall()
+            detailed_results = get_do_number_analysis(cursor_b, sample_do_numbers)
             
             logger.info("   Detailed analysis:")
             for result in detailed_results:
@@ -169,7 +135,7 @@ def debug_february_gap(logger, warehouse_id=4512):
         logger.error(f"Error debugging February gap: {e}")
         return []
     finally:
-        conn_b.close()
+        release_db_connection(conn_b, 'B')
 
 def main():
     """Main function"""
@@ -180,9 +146,9 @@ def main():
         
         if do_numbers_with_items:
             logger.info("\n" + "="*60)
-            logger.info("DO NUMBERS WITH ITEMS (for further investigation):")
-            for do_num in do_numbers_with_items:
-                logger.info(f"  {do_num}")
+            # One log record for the whole list instead of one per DO number
+            logger.info("DO NUMBERS WITH ITEMS (for further investigation):\n" +
+                        "\n".join(f"  {do_num}" for do_num in do_numbers_with_items))
             
             logger.info(f"\nTotal: {len(do_numbers_with_items)} DO numbers")
             logger.info("You can use these DO numbers with debug_missing_order_details.py")
@@ -3,30 +3,9 @@
 Debug script to investigate missing order details
 """
 
-import os
 import sys
-import psycopg2
-from dotenv import load_dotenv
-import logging
-
-# Load environment variables
-load_dotenv('.env')
-
-def setup_logging():
-    """Setup logging configuration"""
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-    return logging.getLogger(__name__)
-
-def get_db_connection(database='B'):
-    """Get database connection"""
-    if database == 'B':
-        return psycopg2.connect(
-            host=os.getenv('DB_B_HOST'),
-            database=os.getenv('DB_B_NAME'),
-            user=os.getenv('DB_B_USER'),
-            password=os.getenv('DB_B_PASSWORD'),
-            port=os.getenv('DB_B_PORT')
-        )
+from db import get_db_connection, release_db_connection
+from debug_common import setup_logging, get_do_number_analysis
 
 def debug_multiple_do_numbers(logger, do_numbers):
     """Debug multiple DO numbers to see why they're not being processed"""
@@ -37,54 +16,58 @@ def debug_multiple_do_numbers(logger, do_numbers):
         
         logger.info(f"=== DEBUGGING {len(do_numbers)} DO NUMBERS ===")
         
-        # Step 1: Check outbound_documents
-        logger.info("1. Checking outbound_documents...")
-        placeholders = ','.join(['%s'] * len(do_numbers))
-        query1 = f"""
-        SELECT id, document_reference, create_date 
-        FROM outbound_documents 
-        WHERE document_reference IN ({placeholders})
+        # Steps 1-4 share one round trip: documents, item counts, orders and
+        # detail counts are each aggregated into a JSON array by a single query
+        query = """
+        WITH docs AS (
+            SELECT id, document_reference
+            FROM outbound_documents
+            WHERE document_reference = ANY(%s)
+        ),
+        items AS (
+            SELECT outbound_document_id, COUNT(*) as item_count
+            FROM outbound_items
+            WHERE outbound_document_id IN (SELECT id FROM docs)
+            GROUP BY outbound_document_id
+        ),
+        orders AS (
+            SELECT do_number, order_id, faktur_date, warehouse_id
+            FROM order_main
+            WHERE do_number IN (SELECT document_reference FROM docs)
+        ),
+        details AS (
+            SELECT order_id, COUNT(*) as detail_count
+            FROM order_detail_main
+            WHERE order_id IN (SELECT order_id FROM orders)
+            GROUP BY order_id
+        )
+        SELECT
+            (SELECT COALESCE(json_agg(json_build_array(id, document_reference)), '[]') FROM docs),
+            (SELECT COALESCE(json_agg(json_build_array(outbound_document_id, item_count)), '[]') FROM items),
+            (SELECT COALESCE(json_agg(json_build_array(do_number, order_id, faktur_date, warehouse_id)), '[]') FROM orders),
+            (SELECT COALESCE(json_agg(json_build_array(order_id, detail_count)), '[]') FROM details)
         """
-        cursor_b.execute(query1, do_numbers)
-        doc_results = cursor_b.fetchall()
+        cursor_b.execute(query, (list(do_numbers),))
+        doc_results, item_results, order_results, detail_results = cursor_b.fetchone()
         
+        # Step 1: Check outbound_documents
+        logger.info("1. Checking outbound_documents...")
         logger.info(f"   ✓ Found {len(doc_results)} documents in outbound_documents")
         
         if not doc_results:
             logger.error(f"   ✗ NO DOCUMENTS found in outbound_documents")
             return
         
-        # Get document IDs
-        doc_ids = [row[0] for row in doc_results]
         found_do_numbers = [row[1] for row in doc_results]
         
         # Step 2: Check outbound_items
         logger.info("2. Checking outbound_items...")
-        placeholders = ','.join(['%s'] * len(doc_ids))
-        query2 = f"""
-        SELECT outbound_document_id, COUNT(*) as item_count
-        FROM outbound_items 
-        WHERE outbound_document_id IN ({placeholders})
-        GROUP BY outbound_document_id
-        """
-        cursor_b.execute(query2, doc_ids)
-        item_results = cursor_b.fetchall()
-        
         total_items = sum(row[1] for row in item_results)
         logger.info(f"   ✓ Found {total_items} total items in outbound_items")
-        logger.info(f"   ✓ Items per document: {dict(item_results)}")
+        logger.info(f"   ✓ Items per document: {dict((row[0], row[1]) for row in item_results)}")
         
         # Step 3: Check order_main
         logger.info("3. Checking order_main...")
-        placeholders = ','.join(['%s'] * len(found_do_numbers))
-        query3 = f"""
-        SELECT do_number, order_id, faktur_date, warehouse_id
-        FROM order_main 
-        WHERE do_number IN ({placeholders})
-        """
-        cursor_b.execute(query3, found_do_numbers)
-        order_results = cursor_b.fetchall()
-        
         logger.info(f"   ✓ Found {len(order_results)} orders in order_main")
         
         if order_results:
@@ -98,19 +81,8 @@ def debug_multiple_do_numbers(logger, do_numbers):
         # Step 4: Check order_detail_main
         logger.info("4. Checking order_detail_main...")
         if order_results:
-            order_ids = [row[1] for row in order_results]
-            placeholders = ','.join(['%s'] * len(order_ids))
-            query4 = f"""
-            SELECT order_id, COUNT(*) as detail_count
-            FROM order_detail_main 
-            WHERE order_id IN ({placeholders})
-            GROUP BY order_id
-            """
-            cursor_b.execute(query4, order_ids)
-            detail_results = cursor_b.fetchall()
-            
             orders_with_details = len(detail_results)
-            orders_without_details = len(order_ids) - orders_with_details
+            orders_without_details = len(order_results) - orders_with_details
             
             logger.info(f"   ✓ Orders with details: {orders_with_details}")
             logger.info(f"   ⚠ Orders without details: {orders_without_details}")
@@ -121,30 +93,7 @@ def debug_multiple_do_numbers(logger, do_numbers):
         
         # Step 5: Test the full JOIN query
         logger.info("5. Testing full JOIN query...")
-        placeholders = ','.join(['%s'] * len(found_do_numbers))
-        query5 = f"""
-        SELECT 
-            odoc.document_reference,
-            om.order_id,
-            om.faktur_date,
-            om.warehouse_id,
-            COUNT(oi.id) as item_count,
-            COUNT(mp.mst_product_id) as product_matches
-        FROM outbound_documents odoc
-        LEFT JOIN outbound_items oi ON odoc.id = oi.outbound_document_id
-        LEFT JOIN order_main om ON om.do_number = odoc.document_reference
-        LEFT JOIN mst_product_main mp ON (
-            mp.sku = oi.product_id 
-            AND mp.pack_id = oi.pack_id 
-            AND mp.warehouse_id = om.warehouse_id
-        )
-        WHERE odoc.document_reference IN ({placeholders})
-        GROUP BY odoc.document_reference, om.order_id, om.faktur_date, om.warehouse_id
-        ORDER BY odoc.document_reference
-        """
-        
-        cursor_b.execute(query5, found_do_numbers)
-        join_results = cursor_b.fetchall()
+        join_results = get_do_number_analysis(cursor_b, found_do_numbers)
         
         logger.info(f"   ✓ JOIN query returned {len(join_results)} records")
         
@@ -169,7 +118,7 @@ def debug_multiple_do_numbers(logger, do_numbers):
     except Exception as e:
         logger.error(f"Error debugging DO numbers: {e}")
     finally:
-        conn_b.close()
+        release_db_connection(conn_b, 'B')
 
 def debug_specific_do_number(logger, do_number):
     """Debug specific DO number to see why it's not being processed"""
@@ -0,0 +1,22 @@
+"""
+Shared command line argument parsing for the copy and check scripts
+"""
+
+import sys
+from datetime import datetime
+
+def parse_copy_args(argv):
+    """Parse and validate <start_date> <end_date> <warehouse_id>, exiting on invalid input"""
+    try:
+        start_date = datetime.strptime(argv[1], '%Y-%m-%d').date()
+        end_date = datetime.strptime(argv[2], '%Y-%m-%d').date()
+        warehouse_id = int(argv[3])
+    except ValueError as e:
+        print(f"Invalid argument: {e}")
+        sys.exit(1)
+
+    if end_date < start_date:
+        print(f"Invalid date range: end_date {end_date} is before start_date {start_date}")
+        sys.exit(1)
+
+    return start_date, end_date, warehouse_id